@@ -4,9 +4,13 @@ import sys
 import time
 import traceback
 
-from utils.pdf_processor import convert_pdf_to_images, pdf_balance
-from utils.ocr_engine import img_to_md
+from utils.pdf_processor import convert_pdf_to_images, extract_page_features, get_pdf_page_count, mark_file_failed, \
+    pdf_balance
+from utils.ocr_engine import img_to_md, get_route_stats
 from utils.file_utils import save_to_json
+from utils.md_postprocess import postprocess_document
+from utils.admission import ADMIT, DEFER, DEFER_SECONDS, check_admission, release_admission
+from utils.profiler import JobProfiler, install_signal_handler
 import boto3
 from pymysql import Connect
 from concurrent.futures import ThreadPoolExecutor
@@ -72,28 +76,41 @@ MAX_WORKERS = 5
 def process_page_wrapper(args):
     """
     包装函数，用于在线程池中运行。
-    接收一个元组参数 (索引, 图片路径, 语言, 总页数)
+    接收一个元组参数 (索引, 图片路径, 语言, 总页数, 页面特征)
     """
-    idx, img_path, lang, total_pages = args
+    idx, img_path, lang, total_pages, features = args
     page_num = idx + 1
 
     print(f"⚡ [线程启动] 第 {page_num}/{total_pages} 页开始处理...")
 
     # 调用核心 OCR 函数
     # 注意：img_to_md 函数内部已经包含了重试机制，这里直接调用即可
-    md_content = img_to_md(img_path, lang)
+    route_info = {}
+    md_content = img_to_md(img_path, lang, features=features, route_info=route_info)
 
-    print(f"✅ [线程完成] 第 {page_num}/{total_pages} 页处理完毕")
+    print(f"✅ [线程完成] 第 {page_num}/{total_pages} 页处理完毕 "
+          f"({route_info.get('model')}, {route_info.get('latency')}s)")
 
     # 返回结构化的单页数据
     return {
         "page": page_num,
         "image_path": img_path,
-        "content": md_content
+        "content": md_content,
+        "route": route_info
     }
 
 
 def process_single_pdf(pdf_path, lang):
+    """
+    解析单个 PDF。PROFILE_MODE 或 SIGUSR1 开启性能分析时，
+    分析结果写入结果目录下的 profile/ (与 pdf_new.json 同级)。
+    """
+    profile_dir = os.path.join(str(pdf_path)[:-4].replace('upload', 'result'), 'profile')
+    with JobProfiler(profile_dir) as profiler:
+        return _process_single_pdf(pdf_path, lang, profiler)
+
+
+def _process_single_pdf(pdf_path, lang, profiler):
     if not os.path.exists(pdf_path):
         print(f"错误: 文件不存在 -> {pdf_path}")
         return
@@ -101,11 +118,21 @@ def process_single_pdf(pdf_path, lang):
     # 1. PDF 转 图片
     # (假设 convert_pdf_to_images 已经在你的代码上下文中定义好了)
     try:
-        img_paths, output_dir = convert_pdf_to_images(pdf_path)
+        with profiler.stage("convert_pdf_to_images"):
+            img_paths, output_dir = convert_pdf_to_images(pdf_path)
     except Exception as e:
         print(f"PDF 转图片失败: {e}")
         return
 
+    # 提取页面特征用于模型路由 (失败不影响识别，全部按无特征处理)
+    try:
+        page_features = extract_page_features(pdf_path)
+    except Exception as e:
+        print(f"页面特征提取失败: {e}")
+        page_features = []
+    if len(page_features) != len(img_paths):
+        page_features = [None] * len(img_paths)
+
     # 准备 JSON 数据结构
     result_data = {
         "filename": os.path.basename(pdf_path),
@@ -118,17 +145,36 @@ def process_single_pdf(pdf_path, lang):
 
     # 2. 准备多线程任务参数
     # 将需要的参数打包成元组列表
-    tasks = [(idx, img_path, lang, len(img_paths)) for idx, img_path in enumerate(img_paths)]
+    tasks = [(idx, img_path, lang, len(img_paths), page_features[idx]) for idx, img_path in enumerate(img_paths)]
 
     # 3. 执行多线程池
     # 使用 map 方法可以保证返回的结果顺序与 tasks 的顺序一致（即按页码排序）
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    with profiler.stage("ocr_thread_pool"), ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         # executor.map 会阻塞主线程，直到所有任务完成，并返回一个迭代器
-        results = list(executor.map(process_page_wrapper, tasks))
+        results = list(executor.map(profiler.wrap(process_page_wrapper), tasks))
+
+    # 整批本地清理：引导点、死循环重复、LaTeX 定界符、表格修复、跨页续接标记
+    with profiler.stage("postprocess_pages"):
+        contents, continuations = postprocess_document([page["content"] for page in results])
+    # 每页内容与 image_path 一一对应，跨页的表格 / 段落只做标记
+    for page, content, continues in zip(results, contents, continuations):
+        page["content"] = content
+        page["continues_from_previous"] = continues
 
     # 将有序的结果赋值给 result_data
     result_data["pages"] = results
 
+    # 本文档各路由的页数、耗时与费用
+    route_summary = {}
+    for page in results:
+        route = page["route"].get("route", "unknown")
+        summary = route_summary.setdefault(route, {"pages": 0, "latency": 0.0, "cost": 0.0})
+        summary["pages"] += 1
+        summary["latency"] += page["route"].get("latency", 0.0)
+        summary["cost"] += page["route"].get("cost", 0.0)
+    print(f"\n📊 路由统计: {route_summary}")
+    print(f"📊 Worker 累计路由统计: {get_route_stats()}")
+
     # 4. 保存为 JSON
     save_json_path = str(pdf_path)[:-4].replace('upload', 'result')
 
@@ -160,23 +206,25 @@ if __name__ == '__main__':
     # 加载模型
     print('load model')
 
+    # kill -USR1 <pid> 开启 / 关闭性能分析，无需重新部署
+    install_signal_handler()
+
     while True:
         print('While loop ---->')
         time.sleep(5)
         response = sqs.receive_message(QueueUrl=QUEUE_URL, MaxNumberOfMessages=1,
                                        WaitTimeSeconds=20)
         if 'Messages' in response:
-            # snapshot1 = tracemalloc.take_snapshot()
             message = response['Messages'][0]
-            sqs.delete_message(QueueUrl=QUEUE_URL, ReceiptHandle=message['ReceiptHandle'])
             print(message)
-            file_map = eval(message['Body'])
             try:
+                file_map = eval(message['Body'])
                 file_id = file_map['file_id']
                 task_id = file_map['task_id']
                 # layout = file_map['layout']
                 pdf_path = os.path.join('/usr/local/src/s3mnt/new_backend/upload', task_id, f"{file_id}.pdf")
                 user_id = file_map['user_id']
+                tenant_id = file_map.get('tenant_id', user_id)
                 parameter = file_map['parameter']
                 lang = file_map['lang']
 
@@ -184,7 +232,52 @@ if __name__ == '__main__':
                 setting_sql = {'host': os.getenv("host", ""), 'port': int(os.getenv("port", "")),
                                'user': os.getenv("user", ""),
                                'password': os.getenv("password", ""), 'database': os.getenv("database", "")}
+            except:
+                # 消息格式错误，重试也无用，直接丢弃
+                print(traceback.format_exc())
+                sqs.delete_message(QueueUrl=QUEUE_URL, ReceiptHandle=message['ReceiptHandle'])
+                continue
+
+            # 准入控制：OCR 之前按页数检查余额、用户并发和页数速率
+            try:
+                admit_page_num = get_pdf_page_count(pdf_path)
+            except:
+                # 文件不存在或已损坏，重试也无用
+                print(traceback.format_exc())
+                decision, reason, fail_status = None, "PDF 无法打开", "invalid pdf"
+            else:
+                try:
+                    decision, reason = check_admission(file_id, task_id, user_id, tenant_id, admit_page_num,
+                                                       setting_sql)
+                except:
+                    # 数据库等临时错误：消息延迟可见后重试，持续失败时按 redrive policy 进入死信队列
+                    print(traceback.format_exc())
+                    sqs.change_message_visibility(QueueUrl=QUEUE_URL, ReceiptHandle=message['ReceiptHandle'],
+                                                  VisibilityTimeout=DEFER_SECONDS)
+                    continue
+                fail_status = "insufficient balance"
+
+            if decision == DEFER:
+                # 以新消息重新入队并延迟，让其他用户的任务先处理。
+                # 新消息的收到次数从零开始，暂缓多少次都不会进入死信队列
+                print(f"⏸️ 暂缓任务 {file_id} (user={user_id}): {reason}")
+                sqs.send_message(QueueUrl=QUEUE_URL, MessageBody=message['Body'], DelaySeconds=DEFER_SECONDS)
+                sqs.delete_message(QueueUrl=QUEUE_URL, ReceiptHandle=message['ReceiptHandle'])
+                continue
+
+            if decision != ADMIT:
+                print(f"⛔ 拒绝任务 {file_id} (user={user_id}): {reason}")
+                try:
+                    mark_file_failed(file_id, task_id, fail_status, setting_sql)
+                except:
+                    # 状态写入失败也要删除消息，否则被拒绝的任务会反复重试
+                    print(traceback.format_exc())
+                sqs.delete_message(QueueUrl=QUEUE_URL, ReceiptHandle=message['ReceiptHandle'])
+                continue
 
+            sqs.delete_message(QueueUrl=QUEUE_URL, ReceiptHandle=message['ReceiptHandle'])
+
+            try:
                 with Connect(**setting_sql) as conn:
                     cursor = conn.cursor()
                     sql = f'UPDATE file_result SET ' \
@@ -204,4 +297,10 @@ if __name__ == '__main__':
 
             except:
                 print(traceback.format_exc())
+            finally:
+                try:
+                    release_admission(file_id, task_id, setting_sql)
+                except:
+                    # 释放失败时由 INFLIGHT_TIMEOUT_SECONDS 兜底
+                    print(traceback.format_exc())
 
@@ -0,0 +1,15 @@
+-- 队列 worker 准入控制记录 (utils/admission.py)，所有 worker 共享
+-- 部署 worker 前执行一次
+CREATE TABLE IF NOT EXISTS parser_admission (
+    id          BIGINT AUTO_INCREMENT PRIMARY KEY,
+    file_id     VARCHAR(64) NOT NULL,
+    task_id     VARCHAR(64) NOT NULL,
+    user_id     VARCHAR(64) NOT NULL,
+    tenant_id   VARCHAR(64) NOT NULL,
+    pages       INT         NOT NULL,
+    admit_time  DATETIME    NOT NULL,
+    finish_time DATETIME    NULL,
+    KEY idx_user_time (user_id, admit_time),
+    KEY idx_tenant_time (tenant_id, admit_time),
+    KEY idx_file (file_id, task_id)
+);
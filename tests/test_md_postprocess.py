@@ -0,0 +1,147 @@
+from utils.md_postprocess import has_runaway_tail, postprocess_document, postprocess_pages
+
+
+def clean(text):
+    return postprocess_pages([text])[0]
+
+
+# ================= 引导点 =================
+
+def test_toc_leader_dots_collapsed():
+    assert clean("第一章 绪论 ............................ 1") == "第一章 绪论 1"
+    assert clean("Chapter 2 . . . . . . . . . 15") == "Chapter 2 15"
+
+
+def test_short_ellipsis_kept():
+    assert clean("Wait... what?") == "Wait... what?"
+
+
+def test_chinese_ellipsis_kept():
+    assert clean("他说......然后离开了。") == "他说......然后离开了。"
+    assert clean("未完待续……") == "未完待续……"
+
+
+def test_dots_in_table_and_code_kept():
+    table = "| Item .......... | 3 |\n|---|---|\n| a | b |"
+    assert clean(table) == "| Item .......... | 3 |\n|---|---|\n| a | b |"
+    code = "Example:\n\n```\nwait .......... 10\n```"
+    assert clean(code) == code
+
+
+def test_runaway_leader_dots_removed():
+    assert clean("Contents\nA ........ 3\nB " + "." * 100) == "Contents\nA 3\nB"
+
+
+# ================= 死循环重复 =================
+
+def test_runaway_fragment_collapsed():
+    assert clean("text " + "foo bar " * 30 + "end") == "text foo bar end"
+
+
+def test_runaway_lines_collapsed():
+    assert clean("line\n" * 12 + "end") == "line\nend"
+
+
+def test_short_repetition_kept():
+    for text in ("hahahahahahaha", "1,000,000,000,000,000,000", "a a a a a a a a"):
+        assert clean(text) == text
+
+
+def test_table_with_repeated_values_kept():
+    row = "| " + " | ".join(["0"] * 25) + " |"
+    assert clean(row).split("\n")[0] == row
+
+    table = "| 1 | 1 |\n|---|---|\n" + "| 1 | 1 |\n" * 12
+    assert clean(table).count("| 1 | 1 |") == 13
+
+
+def test_matrix_with_repeated_values_kept():
+    matrix = "$$\n\\begin{pmatrix} " + "0 & " * 30 + "1 \\end{pmatrix}\n$$"
+    assert clean(matrix) == matrix
+    assert clean("$$\\begin{pmatrix} 0 & 0 & 0 & 0 & 0 & 0 & 1\\end{pmatrix}$$").count("0 &") == 6
+
+
+# ================= LaTeX 定界符 =================
+
+def test_escaped_citation_not_math():
+    assert clean("As shown in \\[12\\]") == "As shown in \\[12\\]"
+    assert clean("\\[3\\] Author. **Title**. 2020.") == "\\[3\\] Author. **Title**. 2020."
+
+
+def test_latex_delimiters_normalised():
+    assert clean("see \\[ a^2 + b^2 \\] here") == "see $$a^2 + b^2$$ here"
+    assert clean("\\[\nx + y\n\\]") == "$$x + y$$"
+    assert clean("where \\(x_i\\) is") == "where $x_i$ is"
+
+
+def test_unclosed_display_math_closed():
+    assert clean("$$\na+b") == "$$\na+b\n$$"
+
+
+def test_inline_double_dollar_not_closed():
+    assert clean("Price is US$$5") == "Price is US$$5"
+
+
+# ================= 表格 =================
+
+def test_table_separator_and_columns_repaired():
+    assert clean("| a | b |\n| 1 | 2 | 3\n| 4") == "| a | b |\n|---|---|\n| 1 | 2 3 |\n| 4 |  |"
+
+
+def test_single_pipe_line_not_table():
+    assert clean("|x| < 1 holds for all x") == "|x| < 1 holds for all x"
+
+
+def test_pipes_inside_math_not_table():
+    assert clean("$$\n|x| \\le 1\n$$") == "$$\n|x| \\le 1\n$$"
+
+
+def test_pipes_inside_code_not_table():
+    text = "```\n| not a table\n```\n\ntext"
+    assert clean(text) == text
+
+
+# ================= 跨页续接 =================
+
+def test_table_with_repeated_header_continues():
+    pages = ["Intro.\n\n| a | b |\n|---|---|\n| 1 | 2 |", "| a | b |\n|---|---|\n| 3 | 4 |\n\nAfter."]
+    assert postprocess_document(pages) == (pages, [False, True])
+
+
+def test_headerless_table_continues_without_new_header():
+    pages = ["| a | b |\n|---|---|\n| 1 | 2 |", "| 3 | 4 |\n| 5 | 6 |\n\nAfter."]
+    assert postprocess_document(pages) == (pages, [False, True])
+
+
+def test_new_table_on_next_page_not_continued():
+    pages = ["| a | b |\n|---|---|\n| 1 | 2 |", "| c | d |\n|---|---|\n| 3 | 4 |"]
+    assert postprocess_document(pages) == (pages, [False, False])
+
+
+def test_paragraph_spanning_pages_flagged():
+    pages = ["The result holds for", "every case.\n\n# Next"]
+    assert postprocess_document(pages) == (pages, [False, True])
+    pages = ["这是一个没有结束的", "段落。\n\n第二段"]
+    assert postprocess_document(pages) == (pages, [False, True])
+
+
+def test_finished_paragraph_not_continued():
+    assert postprocess_document(["Done.", "next page"]) == (["Done.", "next page"], [False, False])
+
+
+def test_error_pages_not_continued():
+    pages = ["Please parse again", "continued text"]
+    assert postprocess_document(pages) == (pages, [False, False])
+
+
+# ================= 末尾死循环 =================
+
+def test_runaway_tail_detection():
+    assert has_runaway_tail("Contents\nA ........ 3\nB " + "." * 100)
+    assert has_runaway_tail("text " + "foo bar " * 30)
+    assert has_runaway_tail("x\n" + "same\n" * 12)
+
+
+def test_normal_toc_is_not_runaway_tail():
+    assert not has_runaway_tail("A ........ 3\nB ........ 5")
+    assert not has_runaway_tail("foo bar " * 30 + "\n\nThe page continues normally.")
@@ -0,0 +1,124 @@
+import datetime
+import os
+
+from dotenv import load_dotenv
+from pymysql import Connect
+
+from .pdf_processor import get_user_balance
+
+# 加载环境变量
+load_dotenv()
+
+# 准入结果
+ADMIT = "admit"  # 立即处理
+DEFER = "defer"  # 暂缓：重新入队并延迟，让其他用户的任务先跑
+REJECT = "reject"  # 拒绝：无法计费的任务，不调用模型
+
+# 单个用户同时处理的任务数 (所有 worker 合计)
+USER_MAX_CONCURRENCY = int(os.getenv("USER_MAX_CONCURRENCY", "1"))
+# 滑动窗口内单个用户 / 租户可处理的页数 (所有 worker 合计，0 表示不限制)
+USER_PAGES_PER_WINDOW = int(os.getenv("USER_PAGES_PER_WINDOW", "500"))
+TENANT_PAGES_PER_WINDOW = int(os.getenv("TENANT_PAGES_PER_WINDOW", "2000"))
+RATE_WINDOW_SECONDS = int(os.getenv("RATE_WINDOW_SECONDS", "3600"))
+# 超过该时长仍未结束的任务视为 worker 已崩溃，不再占用并发名额
+INFLIGHT_TIMEOUT_SECONDS = int(os.getenv("INFLIGHT_TIMEOUT_SECONDS", "7200"))
+
+# 暂缓的任务以新消息重新入队的延迟秒数 (SQS DelaySeconds 上限 900)。
+# 重新入队会重置 ApproximateReceiveCount，被暂缓的任务不会进入死信队列
+DEFER_SECONDS = min(int(os.getenv("ADMISSION_DEFER_SECONDS", "60")), 900)
+
+LOCK_TIMEOUT = int(os.getenv("ADMISSION_LOCK_TIMEOUT", "10"))
+
+# 准入记录表 parser_admission 的建表语句见 sql/parser_admission.sql
+
+
+def _fetch_one(cursor, sql, args):
+    cursor.execute(sql, args)
+    return cursor.fetchone()
+
+
+def _over_rate(used, limit, page_count):
+    """
+    超出页数限制时返回 True。
+    窗口内为空时总是放行，保证超过单窗口限额的大文件最终也能处理。
+    """
+    if limit <= 0:
+        return False
+    used = int(used)
+    return used > 0 and used + page_count > limit
+
+
+def check_admission(file_id, task_id, user_id, tenant_id, page_count, setting_sql):
+    """
+    在 OCR 之前判断任务能否处理 (状态保存在 MySQL，多个 worker 共享)：
+    1. 余额：扣除本用户处理中 (已准入未扣费) 的页数后，余额不足以支付本文件 -> 拒绝
+    2. 并发：本用户处理中的任务数达到上限 -> 暂缓
+    3. 速率：本用户 / 租户窗口内页数超限 -> 暂缓
+    同一租户的判断通过 MySQL GET_LOCK 串行化。准入成功时写入一条记录，
+    处理完后必须调用 release_admission。
+    :return: (ADMIT | DEFER | REJECT, 原因)
+    """
+    price = int(os.getenv("price", ""))
+    now = datetime.datetime.now()
+    window_start = now - datetime.timedelta(seconds=RATE_WINDOW_SECONDS)
+    stale_before = now - datetime.timedelta(seconds=INFLIGHT_TIMEOUT_SECONDS)
+    lock_name = f"parser_admission:{tenant_id}"
+
+    with Connect(**setting_sql) as conn:
+        cursor = conn.cursor()
+
+        if _fetch_one(cursor, 'SELECT GET_LOCK(%s, %s)', (lock_name, LOCK_TIMEOUT))[0] != 1:
+            return DEFER, "获取准入锁超时"
+        try:
+            balance = get_user_balance(user_id, setting_sql)
+            inflight_jobs, inflight_pages = _fetch_one(
+                cursor,
+                'SELECT COUNT(*), COALESCE(SUM(pages), 0) FROM parser_admission '
+                'WHERE user_id=%s AND finish_time IS NULL AND admit_time >= %s',
+                (user_id, stale_before)
+            )
+
+            if balance - (int(inflight_pages) + page_count) * price < 0:
+                return REJECT, f"余额不足: balance={balance}, 处理中 {inflight_pages} 页, 需要 {page_count * price}"
+
+            if inflight_jobs >= USER_MAX_CONCURRENCY:
+                return DEFER, f"用户并发已满 ({inflight_jobs}/{USER_MAX_CONCURRENCY})"
+
+            user_pages = _fetch_one(
+                cursor,
+                'SELECT COALESCE(SUM(pages), 0) FROM parser_admission WHERE user_id=%s AND admit_time >= %s',
+                (user_id, window_start)
+            )[0]
+            if _over_rate(user_pages, USER_PAGES_PER_WINDOW, page_count):
+                return DEFER, f"用户页数超过 {USER_PAGES_PER_WINDOW} 页/{RATE_WINDOW_SECONDS}s"
+
+            tenant_pages = _fetch_one(
+                cursor,
+                'SELECT COALESCE(SUM(pages), 0) FROM parser_admission WHERE tenant_id=%s AND admit_time >= %s',
+                (tenant_id, window_start)
+            )[0]
+            if _over_rate(tenant_pages, TENANT_PAGES_PER_WINDOW, page_count):
+                return DEFER, f"租户页数超过 {TENANT_PAGES_PER_WINDOW} 页/{RATE_WINDOW_SECONDS}s"
+
+            cursor.execute(
+                'INSERT INTO parser_admission(file_id, task_id, user_id, tenant_id, pages, admit_time) '
+                'VALUES (%s, %s, %s, %s, %s, %s)',
+                (file_id, task_id, user_id, tenant_id, page_count, now)
+            )
+            conn.commit()
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', (lock_name,))
+
+    return ADMIT, "ok"
+
+
+def release_admission(file_id, task_id, setting_sql):
+    """任务结束 (无论成功失败) 后释放并发名额和预占的页数"""
+    with Connect(**setting_sql) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE parser_admission SET finish_time=%s '
+            'WHERE file_id=%s AND task_id=%s AND finish_time IS NULL',
+            (datetime.datetime.now(), file_id, task_id)
+        )
+        conn.commit()
@@ -0,0 +1,313 @@
+import re
+
+# 页分隔符：整批页面拼接后每个正则只扫一遍，分隔符本身不会被任何规则匹配
+PAGE_SEP = "\n\x00\n"
+
+# img_to_md 失败时的返回值，这些页不做跨页续接判断
+ERROR_OUTPUT_RE = re.compile(r'^(?:Error: |Please parse again$)')
+
+# ================= 预编译规则 =================
+
+# 整页被模型包在 ```markdown ... ``` 里
+CODE_FENCE_RE = re.compile(r'(\A|\x00\n)```(?:markdown|md)?[ \t]*\n([^\x00]*?)\n```[ \t]*(?=\n\x00|\Z)')
+
+# 目录页引导点：4 个及以上的 . · … ． (允许中间夹空格) 且后面紧跟行末页码，替换为一个空格。
+# 正文里的省略号 (他说......然后) 后面不是行末页码，保持不变
+LEADER_DOTS_RE = re.compile(r'[ \t]*(?:[.·…．][ \t]*){4,}(?=\d+[ \t]*$)', re.MULTILINE)
+# 页末一直画到 token 耗尽的引导点，直接删掉
+RUNAWAY_DOTS_RE = re.compile(r'[ \t]*(?:[.·…．][ \t]*){20,}(?=\n\x00|\Z)')
+
+# 行内死循环：同一片段连续重复 20 次及以上 (正常的表格、矩阵、数字不会重复这么多次)
+REPEATED_FRAGMENT_RE = re.compile(r'(\S[^\n\x00]{1,49}?)\1{19,}')
+
+# 整行死循环：同一行连续出现 10 次及以上
+REPEATED_LINE_RE = re.compile(r'^([^\n\x00]+)\n(?:\1\n){9,}', re.MULTILINE)
+
+# 输出末尾的死循环 (MAX_TOKENS 时模型还在重复)，只检查最后 RUNAWAY_TAIL_CHARS 个字符
+RUNAWAY_TAIL_CHARS = 4000
+TAIL_DOTS_RE = re.compile(r'(?:[.·…．][ \t]*){20,}\s*\Z')
+TAIL_FRAGMENT_RE = re.compile(r'(\S[^\n]{1,49}?)\1{19,}[^\n]{0,50}\s*\Z')
+TAIL_LINE_RE = re.compile(r'^([^\n]+)\n(?:\1\n){9,}[^\n]*\s*\Z', re.MULTILINE)
+
+# LaTeX 定界符统一为 $$ / $。模型常把方括号转义成 \[12\]，只有内容像 LaTeX
+# (含 \ ^ _ =) 或 \[ \] 独占行时才视为公式
+DISPLAY_MATH_RE = re.compile(r'\\\[([^\x00]+?)\\\]')
+INLINE_MATH_RE = re.compile(r'\\\(([^\n\x00]+?)\\\)')
+LATEX_HINT_RE = re.compile(r'[\\^_=]')
+
+# 三个及以上空行压缩为一个
+BLANK_LINES_RE = re.compile(r'\n{3,}')
+
+WORD_RE = re.compile(r'\w')
+TABLE_ROW_RE = re.compile(r'^\s*\|')
+TABLE_SEPARATOR_RE = re.compile(r'^\s*\|?\s*:?-{3,}:?\s*(?:\|\s*:?-{3,}:?\s*)*\|?\s*$')
+
+# 段落结束的标点 (中英文)
+SENTENCE_END_RE = re.compile(r'[.!?。！？:：;；)）"”』」]$')
+# 非正文行：标题、列表、引用、表格、公式、图片
+NON_PARAGRAPH_RE = re.compile(r'^\s*(?:#|[-*+] |\d+[.)] |>|\||\$\$|!\[)')
+CJK_RE = re.compile(r'[぀-ヿ㐀-鿿가-힯]')
+
+
+def _line_bounds(match):
+    """匹配所在行 (到整行开头 / 结尾) 的文本"""
+    text = match.string
+    start = text.rfind('\n', 0, match.start()) + 1
+    end = text.find('\n', match.end())
+    return text[start:match.start()], text[match.end():end if end != -1 else len(text)]
+
+
+def _in_protected_block(match):
+    """匹配位置是否在本页的 $$ 公式块或 ``` 代码块内，或在表格行中"""
+    text = match.string
+    page_start = text.rfind('\x00', 0, match.start()) + 1
+    before = text[page_start:match.start()]
+    if before.count('$$') % 2 or before.count('```') % 2:
+        return True
+    line_prefix, _ = _line_bounds(match)
+    return bool(TABLE_ROW_RE.match(line_prefix or match.group(0)))
+
+
+def _strip_dots(replacement):
+    """引导点替换函数，$$ 公式块、``` 代码块和表格行内的点不动"""
+    def strip(match):
+        if _in_protected_block(match):
+            return match.group(0)
+        return replacement
+    return strip
+
+
+def _collapse_fragment(match):
+    # 只折叠含文字的片段，保留 ------ / ====== 等分隔线，不动表格和公式
+    unit = match.group(1)
+    if not WORD_RE.search(unit) or _in_protected_block(match):
+        return match.group(0)
+    return unit
+
+
+def _collapse_line(match):
+    if _in_protected_block(match):
+        return match.group(0)
+    return match.group(1) + '\n'
+
+
+def _display_math(match):
+    body = match.group(1)
+    line_prefix, line_suffix = _line_bounds(match)
+    if LATEX_HINT_RE.search(body) or (not line_prefix.strip() and not line_suffix.strip()):
+        return f"$${body.strip()}$$"
+    return match.group(0)
+
+
+def _inline_math(match):
+    body = match.group(1)
+    if LATEX_HINT_RE.search(body):
+        return f"${body.strip()}$"
+    return match.group(0)
+
+
+def _clean_batch(pages):
+    """所有页拼成一个字符串，每条规则整批执行一次"""
+    text = PAGE_SEP.join((page or "").strip() for page in pages)
+    text = CODE_FENCE_RE.sub(r'\1\2', text)
+    text = LEADER_DOTS_RE.sub(_strip_dots(' '), text)
+    text = RUNAWAY_DOTS_RE.sub(_strip_dots(''), text)
+    text = REPEATED_FRAGMENT_RE.sub(_collapse_fragment, text)
+    text = REPEATED_LINE_RE.sub(_collapse_line, text)
+    text = DISPLAY_MATH_RE.sub(_display_math, text)
+    text = INLINE_MATH_RE.sub(_inline_math, text)
+    text = BLANK_LINES_RE.sub('\n\n', text)
+    return [page.strip() for page in text.split(PAGE_SEP)]
+
+
+# ================= 表格 =================
+
+def _split_cells(row):
+    row = row.strip()
+    if row.startswith('|'):
+        row = row[1:]
+    if row.endswith('|') and not row.endswith('\\|'):
+        row = row[:-1]
+    return [cell.strip() for cell in re.split(r'(?<!\\)\|', row)]
+
+
+def _is_table(rows):
+    """以 | 开头的连续行只有含分隔行或至少两行时才算表格，|x| < 1 这样的单行正文不动"""
+    return len(rows) >= 2 or any(TABLE_SEPARATOR_RE.match(row) for row in rows)
+
+
+def _has_header(rows):
+    """表格块是否带表头 (第一行后紧跟分隔行)"""
+    return len(rows) >= 2 and TABLE_SEPARATOR_RE.match(rows[1]) is not None
+
+
+def _repair_table(rows, header=True):
+    """
+    补齐表头分隔行，按表头列数对齐每一行。
+    header=False 用于上一页表格的续表：没有表头，只按第一行列数对齐，不补分隔行
+    """
+    # 表头前多余的分隔行
+    while rows and TABLE_SEPARATOR_RE.match(rows[0]):
+        rows = rows[1:]
+    if not rows:
+        return []
+
+    width = len(_split_cells(rows[0]))
+    if header:
+        body = rows[1:]
+        if body and TABLE_SEPARATOR_RE.match(body[0]):
+            body = body[1:]
+        repaired = ["| " + " | ".join(_split_cells(rows[0])) + " |", "|" + "---|" * width]
+    else:
+        body = [row for row in rows if not TABLE_SEPARATOR_RE.match(row)]
+        repaired = []
+
+    for row in body:
+        cells = _split_cells(row)
+        if len(cells) > width:
+            # 多出的列并入最后一列，避免丢内容
+            cells = cells[:width - 1] + [" ".join(cells[width - 1:])]
+        cells += [""] * (width - len(cells))
+        repaired.append("| " + " | ".join(cells) + " |")
+    return repaired
+
+
+def repair_tables(text, continued=False):
+    """
+    修复页面中的所有 Markdown 表格 ($$ 公式块和 ``` 代码块内的行不动)。
+    continued=True 表示页首表格是上一页表格的无表头续表，不补表头
+    """
+    lines = text.split('\n')
+    out = []
+    in_math = in_code = False
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if in_math or in_code or not TABLE_ROW_RE.match(line):
+            if line.lstrip().startswith('```'):
+                in_code = not in_code
+            elif not in_code and line.count('$$') % 2:
+                in_math = not in_math
+            out.append(line)
+            i += 1
+            continue
+        start = i
+        while i < len(lines) and TABLE_ROW_RE.match(lines[i]):
+            i += 1
+        rows = lines[start:i]
+        if continued and start == 0:
+            out.extend(_repair_table(rows, header=False))
+        elif _is_table(rows):
+            out.extend(_repair_table(rows))
+        else:
+            out.extend(rows)
+    return '\n'.join(out)
+
+
+def _close_math(text):
+    """最后一个未配对的 $$ 在行首 (公式块被截断) 时补上结束符，US$$5 这样的行内 $$ 不动"""
+    if text.count('$$') % 2:
+        pos = text.rfind('$$')
+        if not text[text.rfind('\n', 0, pos) + 1:pos].strip():
+            text += '\n$$'
+    return text
+
+
+# ================= 跨页续接 =================
+# 每页内容保持在自己的页里 (与 image_path 对应)，只标记本页开头是否续接上一页
+
+def _leading_table(lines):
+    """页首的表格行 (页首不是表格返回空列表)"""
+    count = 0
+    while count < len(lines) and TABLE_ROW_RE.match(lines[count]):
+        count += 1
+    return lines[:count]
+
+
+def _continues_table(prev_lines, cur_lines):
+    """
+    上一页以表格结尾、本页以同列数的表格开头，且本页重复了上一页的表头或没有表头时，
+    本页的表格是续表
+    """
+    if not TABLE_ROW_RE.match(prev_lines[-1]):
+        return False
+    rows = _leading_table(cur_lines)
+    if not rows:
+        return False
+
+    # 上一页最后一个表格的表头
+    start = len(prev_lines) - 1
+    while start > 0 and TABLE_ROW_RE.match(prev_lines[start - 1]):
+        start -= 1
+    if not _is_table(prev_lines[start:]):
+        return False
+    prev_header = _split_cells(prev_lines[start])
+
+    data = [row for row in rows if not TABLE_SEPARATOR_RE.match(row)]
+    if not data or len(_split_cells(data[0])) != len(prev_header):
+        return False
+    return not _has_header(rows) or _split_cells(rows[0]) == prev_header
+
+
+def _continues_paragraph(prev_lines, cur_lines):
+    """上一页末段未结束、本页首行是续写"""
+    last, first = prev_lines[-1].rstrip(), cur_lines[0].lstrip()
+    if not last or not first:
+        return False
+    if NON_PARAGRAPH_RE.match(last) or NON_PARAGRAPH_RE.match(first) or SENTENCE_END_RE.search(last):
+        return False
+    return bool(CJK_RE.match(first) and CJK_RE.search(last[-1])) or first[0].islower()
+
+
+def _find_continuations(pages):
+    """
+    :return: (continues_table, continues_paragraph) 两个与 pages 等长的列表，
+             第 i 项表示第 i 页开头的表格 / 段落续接第 i-1 页
+    """
+    tables = [False] * len(pages)
+    paragraphs = [False] * len(pages)
+    usable = [bool(page) and not ERROR_OUTPUT_RE.match(page) for page in pages]
+    for i in range(1, len(pages)):
+        if not (usable[i - 1] and usable[i]):
+            continue
+        prev_lines, cur_lines = pages[i - 1].split('\n'), pages[i].split('\n')
+        if _continues_table(prev_lines, cur_lines):
+            tables[i] = True
+        else:
+            paragraphs[i] = _continues_paragraph(prev_lines, cur_lines)
+    return tables, paragraphs
+
+
+def postprocess_document(pages):
+    """
+    对一个文档的所有页做本地清理：
+    1. 整批执行预编译规则：引导点、死循环重复、LaTeX 定界符、代码块包裹
+    2. 判断每页开头的表格 / 段落是否续接上一页
+    3. 逐页修复表格 (续表不补表头)、补齐截断的 $$
+    内容不会在页之间移动，跨页的表格和段落由调用方根据续接标记拼接。
+    :param pages: 按页码排序的 Markdown 文本列表
+    :return: (清理后的文本列表, 每页是否续接上一页的列表)，长度都与 pages 相同
+    """
+    pages = _clean_batch(pages)
+    tables, paragraphs = _find_continuations(pages)
+    cleaned = []
+    for page, continued_table in zip(pages, tables):
+        if not ERROR_OUTPUT_RE.match(page):
+            headerless = continued_table and not _has_header(_leading_table(page.split('\n')))
+            page = _close_math(repair_tables(page, continued=headerless))
+        cleaned.append(page)
+    return cleaned, [table or paragraph for table, paragraph in zip(tables, paragraphs)]
+
+
+def postprocess_pages(pages):
+    """只返回清理后的文本列表 (长度不变)，见 postprocess_document"""
+    return postprocess_document(pages)[0]
+
+
+def has_runaway_tail(text):
+    """
+    输出是否以死循环结尾 (引导点 / 重复片段 / 重复行一直持续到末尾)。
+    MAX_TOKENS 且以死循环结尾说明 token 是被重复内容耗尽的，清理后即可使用。
+    """
+    tail = text.rstrip()[-RUNAWAY_TAIL_CHARS:] + '\n'
+    return bool(TAIL_DOTS_RE.search(tail) or TAIL_LINE_RE.search(tail) or TAIL_FRAGMENT_RE.search(tail))
@@ -7,6 +7,7 @@
 # from PIL import Image
 import io
 import random
+import threading
 import traceback
 
 from dotenv import load_dotenv
@@ -26,6 +27,8 @@ from vertexai.generative_models import (
     Image
 )
 
+from .md_postprocess import has_runaway_tail, postprocess_pages
+
 
 # 加载环境变量
 load_dotenv()
@@ -73,9 +76,43 @@ PROJECT_ID = "yusuan-20260209-0325"
 LOCATION = "global"
 # LOCATION = "us-central1"
 
-# 使用你验证成功的模型
+# 使用你验证成功的模型 (Pro 模型：复杂页面及低置信度页面的兜底)
 MODEL_NAME = "gemini-3-pro-preview"
 
+# ================= 模型路由 =================
+# 普通文字页走便宜快速的模型，公式/表格页直接走 Pro，快速模型失败或低置信度时再升级到 Pro
+FAST_MODEL_NAME = os.getenv("FAST_MODEL_NAME", "gemini-2.5-flash")
+ROUTING_ENABLED = os.getenv("ROUTING_ENABLED", "1") == "1"
+
+# 快速模型能处理好的语言 (小写)，其他语言直接走 Pro
+FAST_MODEL_LANGS = {
+    l.strip().lower()
+    for l in os.getenv("FAST_MODEL_LANGS", "en,english,英文,zh,chinese,中文").split(',')
+    if l.strip()
+}
+
+ROUTE_MATH_CHARS = int(os.getenv("ROUTE_MATH_CHARS", "8"))  # 数学符号数 >= 该值视为公式页
+ROUTE_TABLE_RULES = int(os.getenv("ROUTE_TABLE_RULES", "12"))  # 表格线数 >= 该值视为表格页
+ROUTE_MIN_TEXT_CHARS = int(os.getenv("ROUTE_MIN_TEXT_CHARS", "20"))  # 文本层字数低于该值且有图片视为扫描页
+ROUTE_MIN_COVERAGE = float(os.getenv("ROUTE_MIN_COVERAGE", "0.5"))  # 输出字数/文本层字数 低于该值视为漏识别
+ROUTE_MIN_AVG_LOGPROB = float(os.getenv("ROUTE_MIN_AVG_LOGPROB", "-0.5"))  # 平均 logprob 低于该值视为低置信度
+
+
+def _parse_price(value):
+    """解析 "输入单价,输出单价" (美元 / 百万 token)"""
+    prompt_price, output_price = (float(p) for p in value.split(','))
+    return prompt_price, output_price
+
+
+MODEL_PRICING = {
+    FAST_MODEL_NAME: _parse_price(os.getenv("FAST_MODEL_PRICE", "0.3,2.5")),
+    MODEL_NAME: _parse_price(os.getenv("PRO_MODEL_PRICE", "2.0,12.0")),
+}
+
+# 各路由的累计耗时与费用 (fast: 快速模型, pro: 直接走 Pro, escalated: 快速模型失败后升级到 Pro)
+ROUTE_STATS = {}
+_route_stats_lock = threading.Lock()
+
 # ================= 初始化 =================
 try:
     print(f"🔄 Initializing Vertex AI ({LOCATION})...")
@@ -101,19 +138,147 @@ def get_safety_settings():
     }
 
 
-def img_to_md(image_path, lang="en"):
+def _normal_prompt(img, lang):
+    """正常模式 Prompt"""
+    return [
+        f"你是一个专业的 OCR 工具。请识别图中的{lang}文字并转换为 Markdown。",
+        "如果是数学公式，请严格使用 LaTeX 格式（如 $$...$$）。",
+        "遇到目录页的引导点（......），**必须忽略**，直接输出文字和页码。",
+        "如果图片中没有任何元素，返回""即可",
+        img  # 图片对象直接放入列表
+    ]
+
+
+def select_model(features=None, lang="en"):
     """
-    优化后的 OCR 函数：
-    1. 使用 Gemini 3 Pro Preview
-    2. 使用 Vertex AI Image 类加载
-    3. 包含针对目录页和版权页的自动修复逻辑
+    根据页面的廉价特征 (文本层字数、公式、表格线、语言) 选择模型。
+    扫描页 (几乎没有文本层、只有图片) 和没有特征的页面无法做覆盖率校验，直接走 Pro。
+    :param features: extract_page_features 返回的单页特征
+    :return: (model_name, reason)
     """
-    # print(f"\n========== PROCESSING: {os.path.basename(image_path)} ==========")
+    if not ROUTING_ENABLED or FAST_MODEL_NAME == MODEL_NAME:
+        return MODEL_NAME, "routing_disabled"
+
+    if str(lang).strip().lower() not in FAST_MODEL_LANGS:
+        return MODEL_NAME, f"lang:{lang}"
+
+    if not features:
+        return MODEL_NAME, "no_features"
+    if features.get("text_chars", 0) < ROUTE_MIN_TEXT_CHARS and features.get("image_count", 0) > 0:
+        return MODEL_NAME, "scanned"
+    if features.get("math_fonts") or features.get("math_chars", 0) >= ROUTE_MATH_CHARS:
+        return MODEL_NAME, "formula"
+    if features.get("rule_count", 0) >= ROUTE_TABLE_RULES:
+        return MODEL_NAME, "table"
+
+    return FAST_MODEL_NAME, "plain_text"
+
+
+def _record_call(route, model_name, latency, usage, response=None, error=False):
+    """记录一次模型调用的耗时、token 数和费用"""
+    metadata = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(metadata, "prompt_token_count", 0) or 0
+    output_tokens = getattr(metadata, "candidates_token_count", 0) or 0
+    prompt_price, output_price = MODEL_PRICING.get(model_name, (0.0, 0.0))
+    cost = (prompt_tokens * prompt_price + output_tokens * output_price) / 1_000_000
+
+    usage["latency"] += latency
+    usage["cost"] += cost
+
+    with _route_stats_lock:
+        stats = ROUTE_STATS.setdefault(route, {
+            "model": model_name, "pages": 0, "calls": 0, "errors": 0,
+            "latency": 0.0, "prompt_tokens": 0, "output_tokens": 0, "cost": 0.0,
+        })
+        stats["calls"] += 1
+        stats["errors"] += int(error)
+        stats["latency"] += latency
+        stats["prompt_tokens"] += prompt_tokens
+        stats["output_tokens"] += output_tokens
+        stats["cost"] += cost
+
+
+def get_route_stats():
+    """返回各路由累计统计的快照 (附带平均耗时)"""
+    with _route_stats_lock:
+        snapshot = {route: dict(stats) for route, stats in ROUTE_STATS.items()}
+    for stats in snapshot.values():
+        stats["avg_latency"] = stats["latency"] / stats["calls"] if stats["calls"] else 0.0
+    return snapshot
+
+
+def _generate(model_name, prompt_parts, temperature, route, usage):
+    """发送一次请求，并记录该路由的耗时与费用"""
+    # 注意：Gemini 3 通常不需要 System Instruction，直接写在 Prompt 里效果更好
+    model = GenerativeModel(model_name)
+    start = time.time()
+    try:
+        response = model.generate_content(
+            prompt_parts,
+            generation_config=GenerationConfig(
+                temperature=temperature,
+                top_p=0.95,
+                max_output_tokens=8192,
+            ),
+            safety_settings=get_safety_settings()
+        )
+    except Exception:
+        _record_call(route, model_name, time.time() - start, usage, error=True)
+        raise
+    _record_call(route, model_name, time.time() - start, usage, response=response)
+    return response
 
-    if not os.path.exists(image_path):
-        return "Error: Image file not found."
 
+def _low_confidence_reason(candidate, text, features=None):
+    """判断快速模型的输出是否可信，不可信时返回原因，否则返回 None"""
+    # Token 耗尽且输出以引导点 / 重复死循环结尾时，md_postprocess 可以本地修复，不必升级
+    runaway = candidate.finish_reason == FinishReason.MAX_TOKENS and has_runaway_tail(text)
+    if candidate.finish_reason != FinishReason.STOP and not runaway:
+        return f"finish_reason:{getattr(candidate.finish_reason, 'name', candidate.finish_reason)}"
+
+    # 文本层有字但清理后的输出明显偏少 -> 漏识别 (包括死循环之后丢失的内容)
+    text_chars = (features or {}).get("text_chars", 0)
+    if text_chars and len(postprocess_pages([text])[0]) < text_chars * ROUTE_MIN_COVERAGE:
+        return "low_coverage"
+
+    # Vertex 的 Candidate 封装不一定暴露 avg_logprobs，从原始 proto 读取
+    raw_candidate = getattr(candidate, "_raw_candidate", candidate)
+    avg_logprobs = getattr(raw_candidate, "avg_logprobs", None)
+    if avg_logprobs is not None and avg_logprobs < ROUTE_MIN_AVG_LOGPROB:
+        return "low_logprob"
+
+    return None
+
+
+def _fast_ocr(image_path, lang, model_name, features, usage):
+    """
+    快速模型单次尝试，不做重试 (失败直接升级到 Pro)。
+    :return: (text, escalate_reason)，escalate_reason 为 None 表示结果可用
+    """
+    try:
+        img = Image.load_from_file(image_path)
+        response = _generate(model_name, _normal_prompt(img, lang), 0.1, "fast", usage)
+    except Exception as e:
+        print(f"[Exception] {e}")
+        return None, "exception"
+
+    if not response.candidates:
+        return None, "no_candidates"
+
+    candidate = response.candidates[0]
+    if not (candidate.content and candidate.content.parts):
+        return None, f"blocked:{getattr(candidate.finish_reason, 'name', candidate.finish_reason)}"
+
+    text = candidate.content.parts[0].text
+    return text, _low_confidence_reason(candidate, text, features)
+
+
+def _ocr_with_retries(image_path, lang, route, usage):
+    """
+    Pro 模型识别，包含针对目录页和版权页的自动修复逻辑
+    """
     max_retries = 3
+    last_reason = None
 
     for attempt in range(max_retries):
         try:
@@ -123,16 +288,11 @@ def img_to_md(image_path, lang="en"):
             # 2. 动态 Prompt 策略 (应对死循环和版权拦截)
 
             # --- Attempt 0: 正常模式 ---
-            prompt_parts = [
-                f"你是一个专业的 OCR 工具。请识别图中的{lang}文字并转换为 Markdown。",
-                "如果是数学公式，请严格使用 LaTeX 格式（如 $$...$$）。",
-                "遇到目录页的引导点（......），**必须忽略**，直接输出文字和页码。",
-                "如果图片中没有任何元素，返回""即可",
-                img  # 图片对象直接放入列表
-            ]
-
-            # --- Attempt 1: 严格模式 (针对目录页死循环) ---
-            if attempt == 1:
+            prompt_parts = _normal_prompt(img, lang)
+
+            # --- Attempt 1: 严格模式 (针对目录页死循环，且没有任何输出) ---
+            # 有输出的死循环已直接返回，由 md_postprocess 本地清理；版权拦截直接进入防版权模式
+            if attempt == 1 and last_reason != FinishReason.RECITATION:
                 print(f"[Warning] Retrying {os.path.basename(image_path)} (Strict Mode)...")
                 prompt_parts = [
                     "提取文字。**严重警告：绝对禁止输出任何连续的点号(......)！遇到请直接删除！**",
@@ -141,7 +301,8 @@ def img_to_md(image_path, lang="en"):
                 ]
 
             # --- Attempt 2: 防版权模式 (针对参考文献页) ---
-            if attempt == 2:
+            anti_recitation = attempt == 2 or (attempt == 1 and last_reason == FinishReason.RECITATION)
+            if anti_recitation:
                 print(f"[Warning] Retrying {os.path.basename(image_path)} (Anti-Recitation Mode)...")
                 prompt_parts = [
                     "You are a bibliographic data assistant.",
@@ -151,39 +312,23 @@ def img_to_md(image_path, lang="en"):
                     img
                 ]
 
-            # 3. 加载模型
-            model = GenerativeModel(MODEL_NAME)
-
-            # 4. 发送请求
-            # 注意：Gemini 3 通常不需要 System Instruction，直接写在 Prompt 里效果更好
-            response = model.generate_content(
-                prompt_parts,
-                generation_config=GenerationConfig(
-                    # 重试时降低温度，增加确定性
-                    temperature=0.1 if attempt < 2 else 0.4,
-                    top_p=0.95,
-                    max_output_tokens=8192,
-                ),
-                safety_settings=get_safety_settings()
-            )
-
-            # 5. 结果校验
+            # 3. 发送请求 (重试时降低温度，增加确定性)
+            response = _generate(MODEL_NAME, prompt_parts, 0.4 if anti_recitation else 0.1, route, usage)
+
+            # 4. 结果校验
             if not response.candidates:
+                last_reason = None
                 if attempt < max_retries - 1: continue
                 return "Error: No candidates."
 
             candidate = response.candidates[0]
             finish_reason = candidate.finish_reason
+            last_reason = finish_reason
 
             # === 成功获取文本 ===
+            # Token 耗尽 (可能还在画点) 的输出也直接返回，引导点和重复由 md_postprocess 统一清理
             if candidate.content and candidate.content.parts:
-                text = candidate.content.parts[0].text
-
-                # 如果是因为 Token 耗尽 (可能还在画点)，尝试截断修复
-                if finish_reason == FinishReason.MAX_TOKENS:
-                    text = text.rstrip('. ')
-
-                return text
+                return candidate.content.parts[0].text
 
             # === 失败处理 ===
             # print(f"[Debug] Attempt {attempt+1} Failed. Reason Code: {finish_reason}")
@@ -202,6 +347,7 @@ def img_to_md(image_path, lang="en"):
         except Exception as e:
             print(f"[Exception] {e}")
             print(traceback.format_exc())
+            last_reason = None
             if attempt < max_retries - 1:
                 time.sleep(2)
                 continue
@@ -210,6 +356,54 @@ def img_to_md(image_path, lang="en"):
     return "Error: Failed after retries."
 
 
+def img_to_md(image_path, lang="en", features=None, route_info=None):
+    """
+    优化后的 OCR 函数：
+    1. 按页面特征路由：普通文字页走快速模型，公式/表格页走 Gemini 3 Pro Preview
+    2. 快速模型失败或低置信度时自动升级到 Pro
+    3. 使用 Vertex AI Image 类加载
+    4. 包含针对目录页和版权页的自动修复逻辑
+    :param features: extract_page_features 返回的单页特征 (可选)
+    :param route_info: 可选的 dict，填入本页的路由、模型、耗时和费用
+    """
+    # print(f"\n========== PROCESSING: {os.path.basename(image_path)} ==========")
+
+    if not os.path.exists(image_path):
+        return "Error: Image file not found."
+
+    model_name, reason = select_model(features, lang)
+    usage = {"latency": 0.0, "cost": 0.0}
+    route = "pro"
+    text = None
+
+    if model_name != MODEL_NAME:
+        text, escalate_reason = _fast_ocr(image_path, lang, model_name, features, usage)
+        if escalate_reason is None:
+            route = "fast"
+        else:
+            print(f"[Route] {os.path.basename(image_path)} 升级到 {MODEL_NAME} ({escalate_reason})")
+            route, reason = "escalated", escalate_reason
+            model_name = MODEL_NAME
+
+    if route != "fast":
+        text = _ocr_with_retries(image_path, lang, route, usage)
+
+    with _route_stats_lock:
+        if route in ROUTE_STATS:
+            ROUTE_STATS[route]["pages"] += 1
+
+    if route_info is not None:
+        route_info.update({
+            "route": route,
+            "model": model_name,
+            "reason": reason,
+            "latency": round(usage["latency"], 3),
+            "cost": round(usage["cost"], 6),
+        })
+
+    return text
+
+
 # def get_safety_settings():
 #     return {
 #         HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
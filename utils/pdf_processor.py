@@ -1,4 +1,5 @@
 import os
+import re
 import fitz  # PyMuPDF
 from PIL import Image
 from .file_utils import ensure_directory_exists
@@ -54,6 +55,85 @@ def convert_pdf_to_images(pdf_path):
     return img_path_list, output_path
 
 
+# 数学符号：希腊字母、数学运算符、上下标等
+MATH_CHAR_RE = re.compile(r'[Α-ω∀-⋿⁰-₟⟀-⟯⨀-⫿±×÷]')
+
+# 公式常用字体 (TeX Computer Modern / Cambria Math / Symbol 等)
+MATH_FONT_HINTS = ('math', 'cmmi', 'cmsy', 'cmex', 'msbm', 'symbol', 'stix')
+
+
+def extract_page_features(pdf_path):
+    """
+    读取 PDF 文本层，提取每页的廉价特征，用于 OCR 模型路由。
+    只读文本层和矢量路径，不做渲染，开销远小于一次模型调用。
+    :param pdf_path: PDF 文件路径
+    :return: 每页一个特征字典的列表，顺序与页码一致
+    """
+    features = []
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            text = page.get_text()
+            fonts = [str(font[3]).lower() for font in page.get_fonts()]
+
+            # 表格线：水平/竖直的线段和矩形
+            rule_count = 0
+            for drawing in page.get_drawings():
+                for item in drawing["items"]:
+                    if item[0] == 're':
+                        rule_count += 1
+                    elif item[0] == 'l' and (item[1].x == item[2].x or item[1].y == item[2].y):
+                        rule_count += 1
+
+            features.append({
+                "text_chars": len(text.strip()),
+                "math_chars": len(MATH_CHAR_RE.findall(text)),
+                "math_fonts": any(hint in font for font in fonts for hint in MATH_FONT_HINTS),
+                "rule_count": rule_count,
+                "image_count": len(page.get_images()),
+            })
+
+    return features
+
+
+def get_pdf_page_count(pdf_path):
+    """只打开 PDF 读取页数，不渲染，用于任务准入"""
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+
+def get_user_balance(user_id, setting_sql):
+    """查询用户当前余额 (user_balance 表最新一条记录)"""
+    with Connect(**setting_sql) as conn:
+        se_sql = f'SELECT balance FROM user_balance where user_id="{user_id}"'
+        df = pd.read_sql(sql=se_sql, con=conn)
+    if df.empty:
+        return 0
+    return int(df.iloc[-1]['balance'])
+
+
+# file_result 中记录失败原因的字段 (可选，表中没有该字段时留空)
+FAIL_STATUS_COLUMN = os.getenv("FAIL_STATUS_COLUMN", "")
+
+
+def mark_file_failed(file_id, task_id, reason, setting_sql):
+    """
+    任务不会被处理时写回 file_result：写入 queue_time 表示已出队，
+    配置了 FAIL_STATUS_COLUMN 时同时写入失败原因。不写 parser_time / success_time，避免被当成解析成功。
+    """
+    fail_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with Connect(**setting_sql) as conn:
+        cursor = conn.cursor()
+        if FAIL_STATUS_COLUMN:
+            sql = f'UPDATE file_result SET queue_time=%s, {FAIL_STATUS_COLUMN}=%s WHERE file_id=%s and task_id=%s'
+            args = (fail_time, reason, file_id, task_id)
+        else:
+            sql = 'UPDATE file_result SET queue_time=%s WHERE file_id=%s and task_id=%s'
+            args = (fail_time, file_id, task_id)
+        print(sql, args)
+        cursor.execute(sql, args)
+        conn.commit()
+
+
 def pdf_balance(image_path, task_id, file_id, user_id, pdf_page_num, setting_sql):
 
     image_path_one = os.path.join(image_path, '1.jpg')
@@ -0,0 +1,267 @@
+import cProfile
+import io
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from .file_utils import ensure_directory_exists
+
+# 加载环境变量
+load_dotenv()
+
+# 可选模式 (逗号分隔)：
+#   cpu    - cProfile (主线程 + 线程池中的每个任务；3.12+ 一个 profiler 即覆盖所有线程)
+#   sample - 采样所有线程的调用栈，输出 folded 格式，可直接生成火焰图
+#   mem    - tracemalloc 内存分配差异
+PROFILE_MODES = {m.strip() for m in os.getenv("PROFILE_MODE", "").split(',') if m.strip()}
+# 收到 SIGUSR1 时开启 / 关闭的模式
+SIGNAL_PROFILE_MODES = {m.strip() for m in os.getenv("SIGNAL_PROFILE_MODE", "sample,mem").split(',') if m.strip()}
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.01"))  # 采样间隔 (秒)
+TOP_N = int(os.getenv("PROFILE_TOP_N", "20"))
+
+# 3.12+ 的 cProfile 基于 sys.monitoring，同一时刻只能有一个 profiler，且会覆盖所有线程
+_SINGLE_PROFILER = sys.version_info >= (3, 12)
+
+_signal_enabled = False
+_last_job_snapshot = None  # 上一个任务结束时的内存快照，用于跨任务排查泄漏
+_started_tracing = False  # tracemalloc 是否由本模块开启
+
+# 排除 tracemalloc、本模块自身和导入机制的分配
+_IGNORED_FILES = {
+    tracemalloc.__file__,
+    __file__,
+    "<frozen importlib._bootstrap>",
+    "<frozen importlib._bootstrap_external>",
+    "<unknown>",
+}
+
+
+def _toggle_profiling(signum, frame):
+    """SIGUSR1 处理函数：切换下一个任务起是否开启性能分析"""
+    global _signal_enabled
+    _signal_enabled = not _signal_enabled
+    print(f"🩺 性能分析已{'开启' if _signal_enabled else '关闭'} (SIGUSR1)")
+
+
+def install_signal_handler():
+    """注册 SIGUSR1 (仅主线程、非 Windows 可用)"""
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, _toggle_profiling)
+
+
+def active_modes():
+    """当前生效的分析模式"""
+    return PROFILE_MODES | (SIGNAL_PROFILE_MODES if _signal_enabled else set())
+
+
+def _sync_tracing(modes):
+    """mem 模式开启时持续追踪 (跨任务对比)，关闭后停止追踪，避免常驻开销"""
+    global _last_job_snapshot, _started_tracing
+    if "mem" in modes:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+            _last_job_snapshot = None
+    elif _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+        _last_job_snapshot = None
+
+
+def _take_snapshot():
+    return tracemalloc.take_snapshot()
+
+
+def _format_diff(snapshot, baseline):
+    """按代码行汇总两次快照之间增长最多的分配位置 (对比后再过滤，比 filter_traces 快得多)"""
+    lines = []
+    for stat in snapshot.compare_to(baseline, 'lineno'):
+        if stat.traceback[0].filename in _IGNORED_FILES:
+            continue
+        lines.append(f"  {stat}")
+        if len(lines) >= TOP_N:
+            break
+    return lines
+
+
+class JobProfiler:
+    """
+    单个 PDF 任务的性能分析，未开启任何模式时所有方法都是空操作。
+    用法：
+        with JobProfiler(output_dir) as profiler:
+            with profiler.stage("convert_pdf_to_images"):
+                ...
+            executor.map(profiler.wrap(func), tasks)
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.modes = active_modes()
+        self.enabled = bool(self.modes)
+        self.stage_reports = []
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._samples = Counter()
+        self._sampler = None
+        self._stop_sampling = threading.Event()
+        self._start_time = None
+        self._main_profile = None
+        _sync_tracing(self.modes)
+
+    # ================= 生命周期 =================
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+
+        print(f"🩺 性能分析开启: {sorted(self.modes)}")
+        self._start_time = time.time()
+
+        if "mem" in self.modes:
+            self._job_baseline = _take_snapshot()
+
+        if "cpu" in self.modes:
+            self._main_profile = cProfile.Profile()
+            self._main_profile.enable()
+
+        if "sample" in self.modes:
+            self._sampler = threading.Thread(target=self._sample_loop, name="profile-sampler", daemon=True)
+            self._sampler.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.enabled:
+            return False
+
+        try:
+            if "cpu" in self.modes:
+                self._main_profile.disable()
+                self._profiles.append(self._main_profile)
+
+            if self._sampler is not None:
+                self._stop_sampling.set()
+                self._sampler.join()
+
+            self._write_reports()
+        except Exception as e:
+            print(f"❌ 写入性能分析结果失败: {e}")
+            print(traceback.format_exc())
+        return False
+
+    # ================= 分析钩子 =================
+
+    @contextmanager
+    def _paused(self):
+        """暂停主线程的 cProfile，避免快照和对比的开销混进 cpu.prof"""
+        if self._main_profile is None:
+            yield
+            return
+        self._main_profile.disable()
+        try:
+            yield
+        finally:
+            self._main_profile.enable()
+
+    @contextmanager
+    def stage(self, name):
+        """记录一个阶段的耗时和内存分配增长"""
+        if not self.enabled:
+            yield
+            return
+
+        before = None
+        if "mem" in self.modes:
+            with self._paused():
+                before = _take_snapshot()
+        start = time.time()
+        try:
+            yield
+        finally:
+            report = [f"[{name}] 耗时 {time.time() - start:.2f}s"]
+            if before is not None:
+                with self._paused():
+                    current, peak = tracemalloc.get_traced_memory()
+                    report.append(f"  当前 {current / 1024 / 1024:.1f} MiB, 峰值 {peak / 1024 / 1024:.1f} MiB")
+                    report.append(f"  Top {TOP_N} 分配位置:")
+                    report.extend(_format_diff(_take_snapshot(), before))
+            self.stage_reports.append("\n".join(report))
+
+    def wrap(self, func):
+        """包装线程池任务，cpu 模式下在工作线程内单独做 cProfile (3.12+ 主 profiler 已覆盖，不再包装)"""
+        if "cpu" not in self.modes or _SINGLE_PROFILER:
+            return func
+
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self._lock:
+                    self._profiles.append(profile)
+
+        return profiled
+
+    def _sample_loop(self):
+        """定时采集所有线程 (除自身) 的调用栈"""
+        own_id = threading.get_ident()
+        while not self._stop_sampling.wait(SAMPLE_INTERVAL):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self._samples[";".join(reversed(stack))] += 1
+
+    # ================= 输出 =================
+
+    def _write_reports(self):
+        global _last_job_snapshot
+        ensure_directory_exists(self.output_dir)
+        summary = [f"任务耗时 {time.time() - self._start_time:.2f}s, 模式 {sorted(self.modes)}"]
+
+        if self._profiles:
+            stream = io.StringIO()
+            stats = pstats.Stats(*self._profiles, stream=stream)
+            stats.dump_stats(os.path.join(self.output_dir, "cpu.prof"))
+            stats.sort_stats("cumulative").print_stats(TOP_N)
+            summary.append("\n===== cProfile (cumulative) =====")
+            summary.append(stream.getvalue())
+
+        if self._samples:
+            with open(os.path.join(self.output_dir, "cpu_samples.folded"), 'w', encoding='utf-8') as f:
+                for stack, count in self._samples.items():
+                    f.write(f"{stack} {count}\n")
+            summary.append(f"\n===== 采样: {sum(self._samples.values())} 个样本，见 cpu_samples.folded =====")
+
+        if "mem" in self.modes:
+            snapshot = _take_snapshot()
+            summary.append("\n===== tracemalloc =====")
+            summary.extend(self.stage_reports)
+            summary.append(f"[本任务] Top {TOP_N} 分配位置:")
+            summary.extend(_format_diff(snapshot, self._job_baseline))
+            if _last_job_snapshot is not None:
+                summary.append(f"[相比上一个分析任务结束时] Top {TOP_N} 增长 (持续增长的位置可能泄漏):")
+                summary.extend(_format_diff(snapshot, _last_job_snapshot))
+            _last_job_snapshot = snapshot
+        elif self.stage_reports:
+            summary.extend(self.stage_reports)
+
+        summary_path = os.path.join(self.output_dir, "summary.txt")
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(summary))
+        print(f"🩺 性能分析结果已保存至: {self.output_dir}")